@@ -1,16 +1,21 @@
-from sqlalchemy import create_engine, inspect
-from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy import create_engine, inspect, make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.orm import declarative_base
 import os
+import threading
 import time
 from dotenv import load_dotenv
 
 load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL")
+# Request-path queries use asyncpg; defaults to DATABASE_URL with the driver swapped
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL") or make_url(DATABASE_URL).set(drivername="postgresql+asyncpg")
 
-# Use a specific application name for easier DB monitoring
+# Sync engine: startup DDL and schema inspection only
 engine = create_engine(DATABASE_URL, pool_pre_ping=True, future=True)
-SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False, future=True)
+async_engine = create_async_engine(ASYNC_DATABASE_URL, pool_pre_ping=True)
+AsyncSessionLocal = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
 
 Base = declarative_base()
 
@@ -18,34 +23,67 @@ SCHEMA_NAME = "slspurcinv"
 TABLE_NAME = "v_open_order"
 
 
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 
 # --- Schema Caching with TTL ---
 _schema_cache = None
 _last_schema_update = 0
+_schema_refreshing = False
+_schema_lock = threading.Lock()
 SCHEMA_CACHE_TTL = 3600  # Refresh schema every 1 hour
+SCHEMA_REFRESH_MARGIN = 60  # Start the background refresh this many seconds before the TTL expires
 
 
-def get_schema_snapshot() -> str:
-    """Returns table schema, caching with a TTL to allow DB updates to propagate."""
+def _refresh_schema() -> str:
     global _schema_cache, _last_schema_update
 
-    current_time = time.time()
-
-    if _schema_cache is not None and (current_time - _last_schema_update < SCHEMA_CACHE_TTL):
-        return _schema_cache
-
     print("Refreshing schema snapshot...")
     insp = inspect(engine)
     cols = insp.get_columns(TABLE_NAME, schema=SCHEMA_NAME)
     col_defs = ", ".join([f"{c['name']}:{str(c.get('type'))}" for c in cols])
 
     _schema_cache = f"{SCHEMA_NAME}.{TABLE_NAME}({col_defs})"
-    _last_schema_update = current_time
-    return _schema_cache
\ No newline at end of file
+    _last_schema_update = time.time()
+    return _schema_cache
+
+
+def _refresh_schema_in_background():
+    global _schema_refreshing
+    try:
+        _refresh_schema()
+    except Exception as e:
+        print(f"Schema refresh error: {e}")  # keep serving the stale snapshot
+    finally:
+        _schema_refreshing = False
+
+
+def is_schema_cached() -> bool:
+    """True once a snapshot is loaded; get_schema_snapshot() then never blocks on the DB."""
+    return _schema_cache is not None
+
+
+def get_schema_snapshot() -> str:
+    """
+    Returns table schema, caching with a TTL to allow DB updates to propagate.
+    Near expiry the cached copy keeps being served while a background thread refreshes it;
+    only the very first call (empty cache) blocks on the DB.
+    """
+    global _schema_refreshing
+
+    if _schema_cache is None:
+        with _schema_lock:
+            if _schema_cache is None:
+                return _refresh_schema()
+        return _schema_cache
+
+    if time.time() - _last_schema_update > SCHEMA_CACHE_TTL - SCHEMA_REFRESH_MARGIN:
+        with _schema_lock:
+            start_refresh = not _schema_refreshing
+            _schema_refreshing = True
+        if start_refresh:
+            threading.Thread(target=_refresh_schema_in_background, daemon=True).start()
+
+    return _schema_cache
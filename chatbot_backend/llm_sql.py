@@ -2,19 +2,37 @@ import os
 import re
 import json
 from functools import lru_cache
+from typing import AsyncIterator
 from datetime import datetime
 from dotenv import load_dotenv
 
+import httpx
 from langchain_openai import ChatOpenAI
 from langchain_core.messages import HumanMessage, SystemMessage
 from langchain_core.prompts import ChatPromptTemplate
 
+try:  # Optional: LLMLingua prompt compression for long chat histories
+    from llmlingua import PromptCompressor
+except ImportError:
+    PromptCompressor = None
+
 load_dotenv()
 
 OPENAI_MODEL = os.getenv("OPENAI_MODEL")
 INSIGHT_MODEL = os.getenv("INSIGHT_MODEL")
+REWRITE_MODEL = os.getenv("REWRITE_MODEL", "gpt-4o-mini")
+REWRITE_SERVICE_TIER = os.getenv("REWRITE_SERVICE_TIER")  # e.g. "flex" on models that support it
 SQL_TEMPERATURE = float(os.getenv("SQL_LLM_TEMPERATURE", "0.0"))
 INSIGHT_TEMPERATURE = float(os.getenv("INSIGHT_LLM_TEMPERATURE", "0.2"))
+REWRITE_TEMPERATURE = float(os.getenv("REWRITE_LLM_TEMPERATURE", "0.2"))
+HISTORY_COMPRESSION_ENABLED = os.getenv("HISTORY_COMPRESSION_ENABLED", "false").lower() in ("1", "true", "yes")
+HISTORY_COMPRESSION_MIN_CHARS = int(os.getenv("HISTORY_COMPRESSION_MIN_CHARS", "500"))
+HISTORY_COMPRESSION_RATE = float(os.getenv("HISTORY_COMPRESSION_RATE", "0.5"))
+LLMLINGUA_MODEL = os.getenv("LLMLINGUA_MODEL", "microsoft/llmlingua-2-xlm-roberta-large-meetingbank")
+LLMLINGUA_DEVICE = os.getenv("LLMLINGUA_DEVICE", "cpu")
+OPENAI_TIMEOUT_SECONDS = float(os.getenv("OPENAI_TIMEOUT_SECONDS", "60"))
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "100"))
+OPENAI_MAX_KEEPALIVE = int(os.getenv("OPENAI_MAX_KEEPALIVE", "50"))
 
 
 # -----------------------------
@@ -28,57 +46,36 @@ def _log_error(context: str, err: Exception):
     print(f"{_ts()} | [LLM][ERROR] {context}: {err}")
 
 
-# -----------------------------
-# Column semantics
-# -----------------------------
-COLUMN_GUIDE = """
-Table: slspurcinv.v_open_order
-Customer fields: customer_no, name, city, customer_po_no, customer_type
-Order fields: order_no, line_no, order_date, due_date, order_qty, balance_qty, balance_amount, pick_and_pack_qty, pegging, pick_list, ship_from, ship_via
-Item fields: item_no, description, item_type, item_category, item_sub_category, unit_price
-Sales fields: sales_rep_no, sales_rep_name
-Other: internal_notes
-Purchase order: po_no
-"""
-
 # -----------------------------
 # Prompts
 # -----------------------------
+# Column names and types come from the live schema snapshot, so no separate column guide is sent.
 SQL_SYSTEM = """
-You are a senior data analyst writing a SINGLE, safe PostgreSQL query.
-
-CRITICAL RULES:
-- NEVER generate SQL placeholders (e.g., :param, $1). ALWAYS inline literal values.
-- ALWAYS produce fully executable SQL.
-- Generate EXACTLY ONE statement starting with SELECT or WITH.
-- NEVER modify data.
-- Use the table slspurcinv.v_open_order.
-- Use explicit column names.
-- Use ISO dates 'YYYY-MM-DD'.
-- Use ILIKE for text searches.
+You are a senior data analyst writing ONE read-only PostgreSQL query (SELECT or WITH) on slspurcinv.v_open_order.
+- Inline literal values; NEVER use placeholders (e.g., :param, $1).
+- Use ISO dates 'YYYY-MM-DD' and ILIKE for text searches.
+- Use the conversation context to resolve references.
 - Return ONLY the SQL statement. No markdown, no backticks.
 """
 
+# Volatile part of the prompt: everything here may change per request, so it goes last.
 SQL_USER_PROMPT = """
 Database table: {schema}
-Column semantics: {column_guide}
+Add LIMIT {row_limit}.
 Conversation context: {chat_history}
-User question: {question}
-
-Constraints:
-- Use previous chat turns to resolve references.
-- Add LIMIT {row_limit}.
-
-Return ONLY the executable SQL statement:
+User question: {question}{extra_ctx}
 """
 
 FEW_SHOTS = [
     ("Top 5 customers by total order amount",
      "SELECT customer_no, name, SUM(line_total_amount) AS total_amount FROM slspurcinv.v_open_order GROUP BY customer_no, name ORDER BY total_amount DESC LIMIT 5;"),
-    ("Show orders pending for Bangalore",
-     "SELECT order_no, name, city, due_date FROM slspurcinv.v_open_order WHERE city ILIKE '%Bangalore%' AND balance_qty > 0 ORDER BY due_date ASC LIMIT 50;")
 ]
 
+EXAMPLES_TXT = "\n\n".join(f"Q: {q}\nA: {a}" for q, a in FEW_SHOTS)
+
+# Stable prefix: byte-identical on every call so OpenAI's automatic prompt caching can reuse it.
+SQL_SYSTEM_PROMPT = f"{SQL_SYSTEM}\nExample:\n{EXAMPLES_TXT}\n"
+
 INSIGHT_SYSTEM = """
 You answer the user's question using ONLY the data found in the SQL result rows.
 **Direct Answer Rule:** Detect if the question seeks a single winner (e.g., "Which customer...?"). In these cases, ignore the list format and provide the answer as a single, standalone sentence.
@@ -91,6 +88,7 @@ Formatting Rules:
   - Customer A: 5 orders
   - Customer B: 3 orders
 - If the result is a single fact, provide one clear sentence.
+- Rows may be a sample: when total_rows is larger than the sample, list the sample and state the total count.
 - Do NOT mention "SQL", "query", or "database".
 """
 
@@ -98,41 +96,59 @@ INSIGHT_USER_PROMPT = "Question: {question}\nSQL: {sql}\nRows: {rows_json}\nInsi
 
 REWRITE_SYSTEM = "Rewrite the user question into a clear, database-friendly question. Resolve vague references using history."
 
+# System messages never change, so build them once instead of on every call
+_SQL_SYSTEM_MSG = SystemMessage(content=SQL_SYSTEM_PROMPT)
+_INSIGHT_SYSTEM_MSG = SystemMessage(content=INSIGHT_SYSTEM)
+_REWRITE_SYSTEM_MSG = SystemMessage(content=REWRITE_SYSTEM)
+
 
 # -----------------------------
-# LLM Factories
+# LLM Clients (module-level singletons)
 # -----------------------------
-@lru_cache
-def get_sql_llm() -> ChatOpenAI:
-    return ChatOpenAI(model=OPENAI_MODEL, temperature=SQL_TEMPERATURE, api_key=os.getenv("OPENAI_API_KEY"))
+# One connection pool for every model: HTTP/2 multiplexes concurrent calls over warm TLS connections
+_HTTP_LIMITS = httpx.Limits(max_connections=OPENAI_MAX_CONNECTIONS, max_keepalive_connections=OPENAI_MAX_KEEPALIVE)
+_SHARED_HTTP = httpx.Client(limits=_HTTP_LIMITS, http2=True, timeout=OPENAI_TIMEOUT_SECONDS)
+_SHARED_ASYNC_HTTP = httpx.AsyncClient(limits=_HTTP_LIMITS, http2=True, timeout=OPENAI_TIMEOUT_SECONDS)
+
+
+def _chat_openai(model: str, temperature: float, **kwargs) -> ChatOpenAI:
+    # The SDK sends ChatOpenAI's own timeout with every request, overriding the http client's, so set it here too
+    return ChatOpenAI(model=model, temperature=temperature, api_key=os.getenv("OPENAI_API_KEY"),
+                      timeout=OPENAI_TIMEOUT_SECONDS,
+                      http_client=_SHARED_HTTP, http_async_client=_SHARED_ASYNC_HTTP, **kwargs)
+
 
+async def close_http_clients():
+    """Closes the shared connection pools (app shutdown)."""
+    _SHARED_HTTP.close()
+    await _SHARED_ASYNC_HTTP.aclose()
 
-@lru_cache
-def get_insight_llm() -> ChatOpenAI:
-    return ChatOpenAI(model=INSIGHT_MODEL, temperature=INSIGHT_TEMPERATURE, api_key=os.getenv("OPENAI_API_KEY"))
+
+SQL_LLM = _chat_openai(OPENAI_MODEL, SQL_TEMPERATURE)
+INSIGHT_LLM = _chat_openai(INSIGHT_MODEL, INSIGHT_TEMPERATURE)
+# Rewriting a question is a trivial transformation, so it uses a smaller, faster model
+REWRITE_LLM = _chat_openai(REWRITE_MODEL, REWRITE_TEMPERATURE, service_tier=REWRITE_SERVICE_TIER)
 
 
 # -----------------------------
 # Core Functions
 # -----------------------------
-def to_sql(question: str, schema_text: str, row_limit: int, chat_history_text: str = "",
+async def to_sql(question: str, schema_text: str, row_limit: int, chat_history_text: str = "",
            last_item: str | None = None) -> str:
     try:
-        examples_txt = "\n\n".join([f"Q: {q}\nA: {a}" for q, a in FEW_SHOTS])
-
         extra_ctx = ""
         if last_item:
             extra_ctx = (f"\n\nContext: User previously referenced item '{last_item}'. "
                          f"If vague (e.g., 'this item'), filter for item_no ILIKE '%{last_item}%'.")
 
         msg = SQL_USER_PROMPT.format(
-            schema=schema_text, column_guide=COLUMN_GUIDE, question=question.strip(),
-            chat_history=chat_history_text, row_limit=row_limit
+            schema=schema_text, row_limit=row_limit, chat_history=chat_history_text,
+            question=question.strip(), extra_ctx=extra_ctx
         )
 
-        resp = get_sql_llm().invoke([
-            SystemMessage(content=SQL_SYSTEM),
-            HumanMessage(content=examples_txt + "\n\n" + msg + extra_ctx)
+        resp = await SQL_LLM.ainvoke([
+            _SQL_SYSTEM_MSG,
+            HumanMessage(content=msg)
         ])
 
         return resp.content.strip().strip("`").replace("sql\n", "")
@@ -142,21 +158,26 @@ def to_sql(question: str, schema_text: str, row_limit: int, chat_history_text: s
         raise
 
 
-def to_insight(question: str, sql: str, rows_json: str) -> str:
+async def to_insight(question: str, sql: str, rows_json: str) -> AsyncIterator[str]:
+    """Streams the insight text chunk by chunk as the LLM generates it."""
+    streamed = False
     try:
         prompt = INSIGHT_USER_PROMPT.format(question=question, sql=sql, rows_json=rows_json)
-        resp = get_insight_llm().invoke([SystemMessage(content=INSIGHT_SYSTEM), HumanMessage(content=prompt)])
-        return resp.content.strip()
+        async for chunk in INSIGHT_LLM.astream([_INSIGHT_SYSTEM_MSG, HumanMessage(content=prompt)]):
+            if chunk.content:
+                streamed = True
+                yield chunk.content
     except Exception as e:
         _log_error("to_insight", e)
-        return "No insights available."
+        if not streamed:
+            yield "No insights available."
 
 
-def rewrite_question(question: str, chat_history_text: str, last_item: str | None = None) -> str:
+async def rewrite_question(question: str, chat_history_text: str, last_item: str | None = None) -> str:
     try:
         extra = f"\nKnown entity: last_item = '{last_item}'" if last_item else ""
         prompt = f"History:\n{chat_history_text}\n\nQuestion:\n{question}\n{extra}\n\nRewrite:"
-        resp = get_insight_llm().invoke([SystemMessage(content=REWRITE_SYSTEM), HumanMessage(content=prompt)])
+        resp = await REWRITE_LLM.ainvoke([_REWRITE_SYSTEM_MSG, HumanMessage(content=prompt)])
         return resp.content.strip()
     except Exception:
         return question
@@ -165,15 +186,23 @@ def rewrite_question(question: str, chat_history_text: str, last_item: str | Non
 # -----------------------------
 # Entity Extraction (Pure Functions)
 # -----------------------------
+_RX_ITEM_TOKEN = re.compile(r"\b([A-Z0-9]{2,12}(?:[-_][A-Z0-9]{1,12})+)\b")
+_RX_ENTITY_SQL = re.compile(r"item_no\s*(?:=|ILIKE)\s*'([^']+)'", re.I)
+_ITEM_BLACKLIST = frozenset({"THE", "AND", "COMPANY", "LIMITED", "LTD", "INC", "LLC"})
+
+
 def extract_item_no_from_text(text: str) -> str | None:
     if not text: return None
-    up = text.upper()
-    pattern = r"\b([A-Z0-9]{2,12}(?:[-_][A-Z0-9]{1,12})+)\b"
-    tokens = re.findall(pattern, up)
-    BLACKLIST = {"THE", "AND", "COMPANY", "LIMITED", "LTD", "INC", "LLC"}
+    # Matching is case-insensitive, so memoize on the upper-cased text
+    return _extract_item_no_cached(text.upper())
+
+
+@lru_cache(maxsize=2048)
+def _extract_item_no_cached(up: str) -> str | None:
+    tokens = _RX_ITEM_TOKEN.findall(up)
 
     for token in tokens:
-        if len(token) < 4 or token in BLACKLIST: continue
+        if len(token) < 4 or token in _ITEM_BLACKLIST: continue
         if any(c.isdigit() for c in token) or "-" in token:
             return token
     return None
@@ -183,19 +212,50 @@ def extract_entity_from_sql(sql: str) -> str | None:
     """Extracts item_no literal from generated SQL."""
     if not sql: return None
     # Look for item_no = 'VALUE' or ILIKE 'VALUE'
-    m = re.search(r"item_no\s*(?:=|ILIKE)\s*'([^']+)'", sql, flags=re.IGNORECASE)
+    m = _RX_ENTITY_SQL.search(sql)
     if m:
         # If ILIKE used %wrappers%, strip them
         return m.group(1).replace("%", "").upper().strip()
     return None
 
 
+# -----------------------------
+# History Compression (opt-in via HISTORY_COMPRESSION_ENABLED, needs llmlingua)
+# -----------------------------
+_history_compressor = None
+
+
+def load_history_compressor():
+    """Loads the LLMLingua model at startup (slow, may download it) so no request pays for it."""
+    global _history_compressor
+    if not HISTORY_COMPRESSION_ENABLED:
+        return
+    if PromptCompressor is None:
+        print(f"{_ts()} | [LLM] HISTORY_COMPRESSION_ENABLED is set but llmlingua is not installed; compression off")
+        return
+    _history_compressor = PromptCompressor(
+        model_name=LLMLINGUA_MODEL, use_llmlingua2=True, device_map=LLMLINGUA_DEVICE
+    )
+
+
+def compress_history(chat_history_text: str) -> str:
+    """Drops low-information tokens from long histories; short ones are returned unchanged."""
+    if _history_compressor is None or len(chat_history_text) <= HISTORY_COMPRESSION_MIN_CHARS:
+        return chat_history_text
+    try:
+        result = _history_compressor.compress_prompt(chat_history_text, rate=HISTORY_COMPRESSION_RATE)
+        return result["compressed_prompt"]
+    except Exception as e:
+        _log_error("compress_history", e)
+        return chat_history_text
+
+
 # -----------------------------
 # Chat Chain Factory
 # -----------------------------
 CHAT_SYSTEM = "You are a helpful assistant. Use chat history. Avoid SQL unless asked."
 chat_prompt = ChatPromptTemplate.from_messages([("system", CHAT_SYSTEM), ("human", "{input}")])
-chat_chain = chat_prompt | ChatOpenAI(model=OPENAI_MODEL, temperature=0.4, api_key=os.getenv("OPENAI_API_KEY"))
+chat_chain = chat_prompt | _chat_openai(OPENAI_MODEL, 0.4)
 
 
 def get_base_chat_chain():
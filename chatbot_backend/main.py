@@ -4,23 +4,24 @@ import os
 import uuid
 import time
 import re
-from datetime import datetime, timedelta
 from contextlib import asynccontextmanager
-from typing import Dict, Any
-from threading import Lock
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Dict, Any, AsyncIterable, AsyncIterator, List, Tuple
 
+import orjson
 from fastapi import FastAPI, Depends, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.concurrency import run_in_threadpool  # KEY FIX for blocking I/O
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import text
 
 # LangChain memory imports
 from langchain_core.chat_history import InMemoryChatMessageHistory
 from langchain_core.runnables import RunnableWithMessageHistory
 
-from db_connect import get_db, get_schema_snapshot, Base, engine
+from db_connect import get_db, get_schema_snapshot, is_schema_cached, Base, engine, async_engine, AsyncSessionLocal
 from models import ChatHistory
 import llm_sql
 import utils
@@ -29,8 +30,12 @@ import utils
 # Configuration
 # ------------------------------
 CLEANUP_INTERVAL_SECONDS = int(os.getenv("CLEANUP_INTERVAL_SECONDS", "60"))
-SESSION_TIMEOUT_MINUTES = int(os.getenv("SESSION_TIMEOUT_MINUTES", "30"))
+SESSION_TIMEOUT_SECONDS = int(os.getenv("SESSION_TIMEOUT_MINUTES", "30")) * 60
 ROW_LIMIT = int(os.getenv("ROW_LIMIT", "100"))
+CHAT_LOG_BATCH_SIZE = int(os.getenv("CHAT_LOG_BATCH_SIZE", "50"))
+REWRITE_MAX_WORDS = int(os.getenv("REWRITE_MAX_WORDS", "6"))
+INSIGHT_SAMPLE_ROWS = int(os.getenv("INSIGHT_SAMPLE_ROWS", "10"))
+HISTORY_MAX_TURNS = int(os.getenv("HISTORY_MAX_TURNS", "10"))  # user + assistant message per turn
 
 
 # ------------------------------
@@ -38,44 +43,43 @@ ROW_LIMIT = int(os.getenv("ROW_LIMIT", "100"))
 # ------------------------------
 class SessionManager:
     """
-    Thread-safe session manager.
+    Async session manager; all access happens on the event loop.
+    Existing sessions are read without locking, only creation and cleanup take the lock.
     To scale to multiple workers/pods, replace self._store with Redis.
     """
 
     def __init__(self):
         self._store: Dict[str, Dict[str, Any]] = {}
-        self._lock = Lock()
-
-    def get_session(self, session_id: str) -> Dict[str, Any]:
-        with self._lock:
-            if session_id not in self._store:
-                self._store[session_id] = {
-                    "history": InMemoryChatMessageHistory(),
-                    "last_item": None,
-                    "last_activity": datetime.now()
-                }
-
-            # Update activity
-            self._store[session_id]["last_activity"] = datetime.now()
-            return self._store[session_id]
-
-    def get_history(self, session_id: str) -> InMemoryChatMessageHistory:
-        return self.get_session(session_id)["history"]
-
-    def get_last_item(self, session_id: str) -> str | None:
-        return self.get_session(session_id).get("last_item")
-
-    def set_last_item(self, session_id: str, item: str):
-        with self._lock:
-            if session_id in self._store:
-                self._store[session_id]["last_item"] = item
-
-    def cleanup(self, timeout_minutes: int):
-        with self._lock:
-            now = datetime.now()
+        self._lock = asyncio.Lock()
+
+    async def get_session(self, session_id: str) -> Dict[str, Any]:
+        session = self._store.get(session_id)
+        if session is None:
+            async with self._lock:
+                session = self._store.get(session_id)
+                if session is None:
+                    session = self._store[session_id] = {
+                        "history": InMemoryChatMessageHistory(),
+                        "last_item": None,
+                        "last_activity": time.monotonic()
+                    }
+
+        # Update activity
+        session["last_activity"] = time.monotonic()
+        return session
+
+    @staticmethod
+    def get_history_text(session: Dict[str, Any]) -> str:
+        """Returns the last HISTORY_MAX_TURNS turns as prompt text; the window bounds the join and the prompt size."""
+        window = session["history"].messages[-2 * HISTORY_MAX_TURNS:]
+        return "\n".join(m.content for m in window)
+
+    async def cleanup(self, timeout_seconds: float):
+        async with self._lock:
+            now = time.monotonic()
             expired = [
                 sid for sid, data in self._store.items()
-                if (now - data["last_activity"]) > timedelta(minutes=timeout_minutes)
+                if (now - data["last_activity"]) > timeout_seconds
             ]
             for sid in expired:
                 del self._store[sid]
@@ -85,6 +89,9 @@ class SessionManager:
 
 session_manager = SessionManager()
 
+# Chat log records (session_id, user_message, generated_sql, ai_message) waiting to be written
+CHAT_LOG_QUEUE: asyncio.Queue = asyncio.Queue()
+
 
 # ------------------------------
 # Lifecycle & App
@@ -93,18 +100,55 @@ session_manager = SessionManager()
 async def lifespan(app: FastAPI):
     print("Initializing DB tables...")
     Base.metadata.create_all(bind=engine)
+    # Off unless HISTORY_COMPRESSION_ENABLED; the model load blocks, so keep it off the event loop
+    await asyncio.to_thread(llm_sql.load_history_compressor)
 
     async def background_cleanup():
         while True:
             try:
-                session_manager.cleanup(SESSION_TIMEOUT_MINUTES)
+                await session_manager.cleanup(SESSION_TIMEOUT_SECONDS)
             except Exception as e:
                 print(f"Cleanup error: {e}")
             await asyncio.sleep(CLEANUP_INTERVAL_SECONDS)
 
-    task = asyncio.create_task(background_cleanup())
+    async def background_chat_log_writer():
+        # Runs until it takes the shutdown sentinel (None) off the queue, so a batch is never cut off mid-INSERT
+        stopping = False
+        while not stopping:
+            # Block for the first record, then take whatever queued up meanwhile as one batch
+            batch = []
+            record = await CHAT_LOG_QUEUE.get()
+            while record is not None:
+                batch.append(record)
+                if len(batch) >= CHAT_LOG_BATCH_SIZE or CHAT_LOG_QUEUE.empty():
+                    break
+                record = CHAT_LOG_QUEUE.get_nowait()
+            stopping = record is None
+            if not batch:
+                continue
+            try:
+                await write_chat_log_batch(batch)
+            except Exception as e:
+                print(f"Chat log writer error: {e}")
+
+    cleanup_task = asyncio.create_task(background_cleanup())
+    writer_task = asyncio.create_task(background_chat_log_writer())
     yield
-    task.cancel()
+    cleanup_task.cancel()
+    # Let the writer drain everything queued before the sentinel, then exit on its own
+    CHAT_LOG_QUEUE.put_nowait(None)
+    await asyncio.gather(cleanup_task, writer_task, return_exceptions=True)
+
+    # Flush anything queued after the sentinel (e.g. a stream finishing during shutdown)
+    pending = []
+    while not CHAT_LOG_QUEUE.empty():
+        record = CHAT_LOG_QUEUE.get_nowait()
+        if record is not None:  # sentinel left behind if the writer died early
+            pending.append(record)
+    if pending:
+        await write_chat_log_batch(pending)
+    await async_engine.dispose()
+    await llm_sql.close_http_clients()
 
 
 app = FastAPI(title="ERP Chatbot", lifespan=lifespan)
@@ -130,11 +174,6 @@ class AskRequest(BaseModel):
     session_id: str
 
 
-class AskResponse(BaseModel):
-    summary: str
-    insights: str | None = None
-
-
 class ChatRequest(BaseModel):
     message: str
     session_id: str | None = None
@@ -149,91 +188,168 @@ class SmartRequest(BaseModel):
     session_id: str | None = None
 
 
-class SmartResponse(BaseModel):
-    reply: str
-    mode: str
+# Static reply vocabulary: O(1) set lookups plus one precompiled regex per category
+_GREETINGS = frozenset({"hi", "hello", "hey", "greetings", "good morning", "good afternoon", "good evening"})
+_RX_GREET_PREFIX = re.compile(r"^(?:hi|hello|hey|greetings|good (?:morning|afternoon|evening)) ")
+_ACK = frozenset({"ok", "okay", "cool", "great"})
+_RX_GRATITUDE = re.compile(r"\b(?:thank|thx|appreciated)")  # prefix match keeps "thanks", "thankyou"
+_RX_CLOSE = re.compile(r"^(?:bye|goodbye|see you|cya)\b")
 
 
-def get_static_response(text: str) -> str | None:
+# Users repeat the same short messages ("hi", "thanks"), so memoize on the normalized text
+@lru_cache(maxsize=2048)
+def _static_response_cached(t: str) -> str | None:
     """
-    Returns a static string if the input matches specific greetings or gratitude keywords.
+    Returns a static string if the lower-cased, stripped input matches specific greetings or gratitude keywords.
     Returns None if no match is found.
     """
-    t = text.lower().strip()
-
     # --- 1. Greetings ---
-    # Matches: "hi", "hello", "hi there", "good morning", etc.
-    GREETINGS = ["hi", "hello", "hey", "greetings", "good morning", "good afternoon", "good evening"]
-
     # Check for exact match OR if the sentence starts with a greeting followed by a space
-    if t in GREETINGS or any(t.startswith(g + " ") for g in GREETINGS):
+    if t in _GREETINGS or _RX_GREET_PREFIX.match(t):
         return "Hello! I am your ERP assistant. You can ask me about open orders, items, customers, or pending shipments."
 
     # --- 2. Gratitude & Closing ---
     # Matches: "thank you", "thanks", "thanks a lot", "bye", "ok bye"
-    GRATITUDE = ["thank", "thanks", "thx", "appreciated"]
-    CLOSING = ["bye", "goodbye", "see you", "cya"]
 
     # 'ok' is tricky because it might be "ok show me orders".
     # We only catch 'ok' if it is the ONLY word or strictly "ok thanks".
-    if t in ["ok", "okay", "cool", "great"]:
+    if t in _ACK:
         return "You're welcome! Let me know if you need anything else."
 
-    if any(x in t for x in GRATITUDE):
+    if _RX_GRATITUDE.search(t):
         return "You're very welcome! Happy to help."
 
-    if any(t.startswith(x) for x in CLOSING):
+    if _RX_CLOSE.match(t):
         return "Goodbye! Have a great day."
 
     return None
 
 
-def requires_context_resolution(text: str) -> bool:
+_RX_CTX = re.compile(r"\b(this|that|these|those|it|its|they|them|same|previous|above|last|earlier)\b")
+
+
+@dataclass(frozen=True)
+class QuestionFeatures:
+    """Everything the SQL pipeline derives from the raw question, computed in one pass."""
+    lower: str
+    static_reply: str | None
+    item_no: str | None
+    needs_context: bool  # implies a reference to previous chat context
+    needs_rewrite: bool  # short follow-up built around a reference ("what about that one?")
+    pending: bool
+
+
+def analyze_question(question: str) -> QuestionFeatures:
+    lower = question.lower().strip()
+    tokens = lower.split()
+    has_reference = bool(_RX_CTX.search(lower))
+    return QuestionFeatures(
+        lower=lower,
+        static_reply=_static_response_cached(lower),
+        item_no=llm_sql.extract_item_no_from_text(question),
+        # Extremely short follow-up queries count as contextual too
+        needs_context=has_reference or len(tokens) <= 3,
+        # Anything longer is sent to to_sql as-is; its prompt resolves references from the history
+        needs_rewrite=has_reference and len(tokens) <= REWRITE_MAX_WORDS,
+        pending=utils.implies_pending(lower),
+    )
+
+# ------------------------------
+# Server-Sent Events helpers
+# ------------------------------
+def _sse(data: Dict[str, Any], event: str | None = None) -> str:
+    """Formats one SSE frame. Payloads are JSON so multi-line text survives framing."""
+    frame = f"event: {event}\n" if event else ""
+    return frame + f"data: {json.dumps(data)}\n\n"
+
+
+async def sse_stream(tokens: AsyncIterable[str] | List[str], **meta: Any) -> AsyncIterator[str]:
+    """
+    Event protocol shared by /ask and /smart:
+      event: meta   -> {"summary": ..., "mode": ...}   (only when meta is given)
+      (message)     -> {"token": "..."}               (one per streamed chunk)
+      event: done   -> {}
+    """
+    if meta:
+        yield _sse(meta, event="meta")
+    if isinstance(tokens, list):
+        for token in tokens:
+            yield _sse({"token": token})
+    else:
+        async for token in tokens:
+            yield _sse({"token": token})
+    yield _sse({}, event="done")
+
+
+# ------------------------------
+# Background work
+# ------------------------------
+async def write_chat_log_batch(records: list):
+    """Writes queued chat logs in one INSERT using a dedicated DB session."""
+    async with AsyncSessionLocal() as db:
+        await utils.save_chat_records(db, records)
+
+
+def build_insight_rows_json(rows: list) -> str:
     """
-    Returns True if the user input implies a reference to previous chat context
+    Bounds the rows sent to the insight LLM: a single row goes as-is,
+    larger results as the first INSIGHT_SAMPLE_ROWS rows plus the total count.
     """
-    t = text.lower().strip()
+    if len(rows) == 1:
+        payload = rows[0]
+    else:
+        payload = {"sample": rows[:INSIGHT_SAMPLE_ROWS], "total_rows": len(rows)}
+    return orjson.dumps(payload, default=str).decode()
 
-    pattern = r"\b(this|that|these|those|it|its|they|them|same|previous|above|last|earlier)\b"
-    if re.search(pattern, t):
-        return True
 
-    # Check for extremely short follow-up queries
-    words = t.split()
-    if len(words) <= 3:
-        return True
+async def fetch_rows(db: AsyncSession, sql: str) -> list:
+    # mappings() builds the key->value rows in SQLAlchemy's C extension; dict() keeps them JSON-friendly
+    result = await db.execute(text(sql))
+    return [dict(r) for r in result.mappings()]
 
-    return False
 
 # ------------------------------
-# Core Logic (Synchronous)
+# Core Logic (Async)
 # ------------------------------
-def handle_sql_query_sync(question: str, session_id: str, db: Session) -> AskResponse:
-    """Synchronous core logic to be run in threadpool."""
+async def prepare_sql_query(question: str, session_id: str, db: AsyncSession,
+                            features: QuestionFeatures | None = None) -> Tuple[str | None, list, str | None]:
+    """
+    Generates, sanitizes and executes the SQL. LLM and DB calls are native async;
+    only CPU-bound or sync-only helpers (schema inspection, history compression) use worker threads.
+    Returns (cleaned_sql, rows, reply). `reply` is set when the turn ends early
+    (static answer or rejected SQL) and no insight needs to be streamed.
+    Callers that already ran analyze_question pass its `features` to avoid a second pass.
+    """
 
-    # 1. Retrieve Context
-    history_obj = session_manager.get_history(session_id)
+    # 1. Retrieve Context (one session lookup for the whole request)
+    session = await session_manager.get_session(session_id)
+    history_obj = session["history"]
     # We still save the message to the DB/History object for record-keeping
     history_obj.add_user_message(question)
+    features = features or analyze_question(question)
 
-    # Load full history text, but we might NOT use it for generation
-    chat_history_text = "\n".join([m.content for m in history_obj.messages])
+    # Load recent history text, but we might NOT use it for generation
+    chat_history_text = session_manager.get_history_text(session)
 
     # Retrieve last entity, but we might NOT use it
-    last_item = session_manager.get_last_item(session_id)
+    last_item = session["last_item"]
 
     # 2. Extract Entity from User Question (if any)
     # If the user names a NEW item explicitly, we always capture it.
-    user_item = llm_sql.extract_item_no_from_text(question)
+    user_item = features.item_no
     if user_item:
-        session_manager.set_last_item(session_id, user_item)
+        session["last_item"] = user_item
         last_item = user_item  # Update local var for immediate use
 
     # 3. Quick Polite Check
-    static_reply = get_static_response(question)
+    static_reply = features.static_reply
     if static_reply:
         history_obj.add_ai_message(static_reply)
-        return AskResponse(summary=static_reply, insights=None)
+        return None, [], static_reply
+
+    # A cached schema is a plain read; only the cold load goes to a thread, in parallel with
+    # the context resolution below (which may call the LLM)
+    schema_task = None if is_schema_cached() else asyncio.create_task(asyncio.to_thread(get_schema_snapshot))
 
     # 4. CONDITIONAL CONTEXT LOGIC (The Fix)
     # ---------------------------------------------------------
@@ -242,12 +358,15 @@ def handle_sql_query_sync(question: str, session_id: str, db: Session) -> AskRes
     item_to_use = None  # Default to None (fresh start)
 
     # Check if the user is referring to the past ("this", "that", "it", etc.)
-    if requires_context_resolution(question):
+    if features.needs_context:
         print(f"Context trigger detected in: '{question}'. Keeping history.")
-        history_to_use = chat_history_text
+        # Only the history is compressed; schema and instructions go to the LLM verbatim
+        history_to_use = await asyncio.to_thread(llm_sql.compress_history, chat_history_text)
         item_to_use = last_item
-        # Optional: Rewrite only if context is needed
-        final_question = llm_sql.rewrite_question(question, chat_history_text, last_item)
+        # Rewrite (an extra LLM round-trip) only for short pronoun follow-ups without an explicit item;
+        # otherwise to_sql resolves the references from the history it already receives.
+        if not user_item and features.needs_rewrite:
+            final_question = await llm_sql.rewrite_question(question, chat_history_text, last_item)
     else:
         print(f"No context trigger. Fresh start.")
         # We purposely send EMPTY history and NO last_item to the SQL LLM.
@@ -257,11 +376,11 @@ def handle_sql_query_sync(question: str, session_id: str, db: Session) -> AskRes
         final_question = question
     # ---------------------------------------------------------
 
-    schema_text = get_schema_snapshot()
+    schema_text = await schema_task if schema_task else get_schema_snapshot()
 
     try:
         # Pass the CONDITIONAL history and item, not the full session ones
-        sql = llm_sql.to_sql(final_question, schema_text, ROW_LIMIT, history_to_use, item_to_use)
+        sql = await llm_sql.to_sql(final_question, schema_text, ROW_LIMIT, history_to_use, item_to_use)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -269,52 +388,58 @@ def handle_sql_query_sync(question: str, session_id: str, db: Session) -> AskRes
     # If the generated SQL contains a NEW item, update the session
     sql_item = llm_sql.extract_entity_from_sql(sql)
     if sql_item:
-        session_manager.set_last_item(session_id, sql_item)
+        session["last_item"] = sql_item
         item_to_use = sql_item  # Update for the safety filters below
 
     # 6. Safety & Cleanup
-    # Filter cleanup should rely on the item actually used in the query generation
-    allowed_items = {item_to_use} if item_to_use else None
-    sql = utils.remove_hallucinated_item_filters(sql, allowed_items)
-
-    if utils.implies_pending(question) and not utils.has_balance_filter(sql):
-        sql = utils.add_pending_filter(sql)
-
+    # Filter cleanup should rely on the item actually used in the query generation (and the one the user named)
+    allowed_items = {item for item in (item_to_use, user_item) if item} or None
+    # Placeholders go first: the parser would otherwise keep (and re-render) them as parameters
     sql = utils.remove_bind_params(sql)
+    # Item filter cleanup, pending filter and LIMIT in one parse
+    sql = utils.rewrite_generated_sql(sql, allowed_items, features.pending, ROW_LIMIT, question)
     allowed, cleaned, reason = utils.sanitize_sql(sql)
 
     if not allowed or not cleaned:
         fail_msg = f"Rejected SQL: {reason}"
         history_obj.add_ai_message(fail_msg)
-        return AskResponse(summary=fail_msg)
-
-    # Ensure LIMIT
-    if "limit" not in cleaned.lower():
-        cleaned = cleaned.rstrip(";") + f" LIMIT {ROW_LIMIT};"
+        return cleaned, [], fail_msg
 
     # 7. Execution
     try:
-        result = db.execute(text(cleaned))
-        rows = [dict(zip(result.keys(), r)) for r in result.fetchall()]
+        rows = await fetch_rows(db, cleaned)
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         err_msg = f"Query failed: {str(e)}"
         history_obj.add_ai_message(err_msg)
         raise HTTPException(status_code=500, detail=err_msg)
 
-    # 8. Insights
-    if rows:
-        rows_json = json.dumps(rows, default=str)
-        insights = llm_sql.to_insight(question, cleaned, rows_json)
-    else:
-        insights = "I couldn't find any records matching your request."
+    return cleaned, rows, None
 
-    # Save to DB Log and Memory
-    utils.save_chat_record(db, session_id, question, cleaned, insights)
-    history_obj.add_ai_message(insights)
 
-    summary = "Here are the results." if rows else "No matching records found."
-    return AskResponse(summary=summary, insights=insights)
+async def stream_sql_insights(question: str, session_id: str, cleaned: str, rows: list) -> AsyncIterator[str]:
+    """
+    Streams the insight tokens, then records the answer. If the client disconnects mid-stream
+    the partial answer is still recorded, so the turn is never lost from history or the DB log.
+    """
+    session = await session_manager.get_session(session_id)
+    parts = []
+    try:
+        # 8. Insights
+        if rows:
+            rows_json = build_insight_rows_json(rows)
+            async for token in llm_sql.to_insight(question, cleaned, rows_json):
+                parts.append(token)
+                yield token
+        else:
+            parts.append("I couldn't find any records matching your request.")
+            yield parts[0]
+    finally:
+        # No awaits here: the generator may be closing because the request was cancelled.
+        # Save to Memory now; the DB log is written by the background chat log writer
+        insights = "".join(parts).strip()
+        session["history"].add_ai_message(insights)
+        CHAT_LOG_QUEUE.put_nowait((session_id, question, cleaned, insights))
 
 
 # ------------------------------
@@ -323,74 +448,85 @@ def handle_sql_query_sync(question: str, session_id: str, db: Session) -> AskRes
 @app.post("/session/start", response_model=StartSessionResponse)
 async def start_session():
     sid = uuid.uuid4().hex
-    session_manager.get_session(sid)  # Init
+    await session_manager.get_session(sid)  # Init
     return StartSessionResponse(session_id=sid)
 
 
-@app.post("/ask", response_model=AskResponse)
-async def ask(payload: AskRequest, db: Session = Depends(get_db)):
-    # Run the synchronous logic in a thread to avoid blocking the event loop
-    return await run_in_threadpool(handle_sql_query_sync, payload.question, payload.session_id, db)
+@app.post("/ask", response_class=StreamingResponse)
+async def ask(payload: AskRequest, db: AsyncSession = Depends(get_db)):
+    """Streams the answer as SSE: `meta` carries the summary, tokens carry the insights."""
+    cleaned, rows, reply = await prepare_sql_query(payload.question, payload.session_id, db)
+
+    if reply is not None:
+        events = sse_stream([], summary=reply)
+    else:
+        summary = "Here are the results." if rows else "No matching records found."
+        insights = stream_sql_insights(payload.question, payload.session_id, cleaned, rows)
+        events = sse_stream(insights, summary=summary)
+    return StreamingResponse(events, media_type="text/event-stream")
 
 
 @app.post("/chat", response_model=ChatResponse)
 async def chat(payload: ChatRequest):
     session_id = payload.session_id or uuid.uuid4().hex
-
-    # Helper for chat chain with history
-    def run_chat():
-        base_chain = llm_sql.get_base_chat_chain()
-        chain_with_history = RunnableWithMessageHistory(
-            base_chain,
-            session_manager.get_history,
-            input_messages_key="input",
-            history_messages_key="chat_history"
-        )
-        res = chain_with_history.invoke({"input": payload.message}, config={"session_id": session_id})
-        return res.content if hasattr(res, "content") else str(res)
-
-    reply = await run_in_threadpool(run_chat)
+    history = (await session_manager.get_session(session_id))["history"]
+
+    base_chain = llm_sql.get_base_chat_chain()
+    chain_with_history = RunnableWithMessageHistory(
+        base_chain,
+        lambda _: history,
+        input_messages_key="input",
+        history_messages_key="chat_history"
+    )
+    res = await chain_with_history.ainvoke({"input": payload.message}, config={"session_id": session_id})
+    reply = res.content if hasattr(res, "content") else str(res)
     return ChatResponse(reply=reply)
 
 
-@app.post("/smart", response_model=SmartResponse)
-async def smart_router(payload: SmartRequest, db: Session = Depends(get_db)):
+@app.post("/smart", response_class=StreamingResponse)
+async def smart_router(payload: SmartRequest, db: AsyncSession = Depends(get_db)):
+    """Streams the reply as SSE: `meta` carries the mode, tokens carry the reply text."""
     session_id = payload.session_id or uuid.uuid4().hex
     text_in = payload.message.strip()
+    # One analysis pass serves the routing below and the SQL pipeline
+    features = analyze_question(text_in)
 
     # --- NEW: Check Static Response First ---
-    static_reply = get_static_response(text_in)
+    static_reply = features.static_reply
     if static_reply:
         # If it's a greeting, we can consider it "chat" mode but with instant reply
-        return SmartResponse(reply=static_reply, mode="static")
+        return StreamingResponse(sse_stream([static_reply], mode="static"), media_type="text/event-stream")
     # ----------------------------------------
 
     # Smart Routing Heuristics
     is_sql = False
     BUSINESS_KEYWORDS = ["order", "customer", "item", "pending", "balance", "qty", "sales", "invoice"]
 
-    if any(k in text_in.lower() for k in BUSINESS_KEYWORDS):
+    if any(k in features.lower for k in BUSINESS_KEYWORDS):
         is_sql = True
 
     # Fallback for "help" or vague questions handled by Chat LLM
-    if text_in.lower() in ["help", "what can you do"]:
+    if features.lower in ["help", "what can you do"]:
         is_sql = False
 
     if is_sql:
-        resp = await run_in_threadpool(handle_sql_query_sync, text_in, session_id, db)
-        return SmartResponse(reply=resp.insights or resp.summary, mode="sql")
+        cleaned, rows, reply = await prepare_sql_query(text_in, session_id, db, features)
+        tokens = [reply] if reply is not None else stream_sql_insights(text_in, session_id, cleaned, rows)
+        return StreamingResponse(sse_stream(tokens, mode="sql"), media_type="text/event-stream")
     else:
+        history = (await session_manager.get_session(session_id))["history"]
+
         # Re-use chat route logic
-        def run_chat():
+        async def stream_chat():
             base_chain = llm_sql.get_base_chat_chain()
             chain_with_history = RunnableWithMessageHistory(
                 base_chain,
-                session_manager.get_history,
+                lambda _: history,
                 input_messages_key="input",
                 history_messages_key="chat_history"
             )
-            res = chain_with_history.invoke({"input": text_in}, config={"session_id": session_id})
-            return res.content
+            async for chunk in chain_with_history.astream({"input": text_in}, config={"session_id": session_id}):
+                if chunk.content:
+                    yield chunk.content
 
-        reply = await run_in_threadpool(run_chat)
-        return SmartResponse(reply=str(reply), mode="chat")
\ No newline at end of file
+        return StreamingResponse(sse_stream(stream_chat(), mode="chat"), media_type="text/event-stream")
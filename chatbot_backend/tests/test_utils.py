@@ -0,0 +1,77 @@
+import llm_sql
+import utils
+
+
+def rewrite(sql, allowed_items=None, pending=True):
+    return utils.rewrite_generated_sql(sql, allowed_items, pending, 100)
+
+
+def test_pending_filter_goes_into_cte_body():
+    sql = ("WITH c AS (SELECT customer_no, SUM(balance_amount) AS amt FROM slspurcinv.v_open_order GROUP BY customer_no) "
+           "SELECT customer_no, amt FROM c ORDER BY amt DESC")
+    out = rewrite(sql)
+    assert "FROM slspurcinv.v_open_order WHERE balance_qty > 0 GROUP BY customer_no" in out
+    assert "FROM c ORDER BY" in out
+
+
+def test_pending_filter_goes_into_derived_table():
+    sql = ("SELECT s.customer_no, s.amt FROM (SELECT customer_no, SUM(balance_amount) AS amt "
+           "FROM slspurcinv.v_open_order o WHERE o.city = 'Pune' GROUP BY customer_no) s")
+    out = rewrite(sql)
+    assert "WHERE o.city = 'Pune' AND o.balance_qty > 0 GROUP BY" in out
+    assert out.count("balance_qty > 0") == 1
+
+
+def test_pending_filter_added_to_every_union_branch():
+    sql = ("SELECT item_no FROM slspurcinv.v_open_order WHERE city = 'Pune' "
+           "UNION SELECT item_no FROM slspurcinv.v_open_order WHERE city = 'Delhi'")
+    out = rewrite(sql)
+    assert out.count("balance_qty > 0") == 2
+    assert out.endswith("LIMIT 100")
+
+
+def test_pending_filter_keeps_or_grouped():
+    out = rewrite("SELECT * FROM slspurcinv.v_open_order WHERE city = 'Pune' OR city = 'Delhi'")
+    assert "WHERE (city = 'Pune' OR city = 'Delhi') AND balance_qty > 0" in out
+
+
+def test_existing_balance_filter_is_not_duplicated():
+    sql = "SELECT * FROM slspurcinv.v_open_order WHERE balance_qty > 0 LIMIT 5"
+    assert rewrite(sql) == sql
+
+
+def test_description_filter_from_question_is_kept():
+    sql = "SELECT * FROM slspurcinv.v_open_order WHERE city = 'Pune' AND description ILIKE '%steel pipe%'"
+    out = utils.rewrite_generated_sql(sql, None, False, 100, "Show orders in Pune for steel pipe")
+    assert "description ILIKE '%steel pipe%'" in out
+
+
+def test_leading_description_filter_is_kept():
+    sql = "SELECT * FROM slspurcinv.v_open_order WHERE description ILIKE '%flange%'"
+    assert "description ILIKE '%flange%'" in rewrite(sql, pending=False)
+
+
+def test_or_branches_are_not_split():
+    sql = "SELECT * FROM slspurcinv.v_open_order WHERE item_no ILIKE '%AB-12%' OR item_no ILIKE '%CD-34%'"
+    out = rewrite(sql, allowed_items={"AB-12"}, pending=False)
+    assert "item_no ILIKE '%AB-12%' OR item_no ILIKE '%CD-34%'" in out
+
+
+def test_unrequested_and_item_filter_is_dropped():
+    sql = "SELECT * FROM slspurcinv.v_open_order WHERE city = 'Pune' AND item_no ILIKE '%ZZ-99%'"
+    out = utils.rewrite_generated_sql(sql, None, False, 100, "orders in Pune")
+    assert "ZZ-99" not in out
+    assert "WHERE city = 'Pune'" in out
+
+
+def test_unrequested_item_filter_is_dropped_with_main_allowed_items():
+    # Same allowed_items as prepare_sql_query: the first SQL item plus the item the user named
+    question = "orders for AB-12 in Pune"
+    sql = ("SELECT * FROM slspurcinv.v_open_order WHERE city = 'Pune' "
+           "AND item_no ILIKE '%AB-12%' AND item_no ILIKE '%ZZ-99%'")
+    item_to_use = llm_sql.extract_entity_from_sql(sql)
+    user_item = llm_sql.extract_item_no_from_text(question)
+    allowed_items = {item for item in (item_to_use, user_item) if item} or None
+    out = utils.rewrite_generated_sql(sql, allowed_items, False, 100, question)
+    assert "AB-12" in out
+    assert "ZZ-99" not in out
@@ -1,10 +1,22 @@
 from typing import Tuple
 import re
+import sqlglot
+from sqlglot import exp
+from sqlalchemy import insert
 from models import ChatHistory
+from db_connect import SCHEMA_NAME, TABLE_NAME
 
 ALLOWED_PREFIXES = ("SELECT", "WITH")
 FORBIDDEN = ("DROP ", "DELETE ", "INSERT ", "UPDATE ", "ALTER ", "TRUNCATE ", "EXEC ", "CREATE ", "GRANT ", "REVOKE ")
 
+# Pre-compiled patterns (hot path: run on every generated query)
+_RX_BALANCE = re.compile(r"balance_qty\s*>\s*0", re.I)
+_RX_WHERE = re.compile(r"\bWHERE\b", re.I)
+_RX_SUFFIX = re.compile(r"\b(GROUP BY|ORDER BY|LIMIT)\b", re.I)
+_RX_BIND = re.compile(r":\w+|\$\d+|@\w+")  # :abc, $1, @p1
+
+ITEM_FILTER_COLUMNS = ("item_no", "description")
+
 
 def sanitize_sql(sql: str) -> Tuple[bool, str | None, str | None]:
     """Basic guardrail: only allow read-only queries."""
@@ -33,7 +45,7 @@ def implies_pending(question: str) -> bool:
 
 
 def has_balance_filter(sql: str) -> bool:
-    return bool(re.search(r"balance_qty\s*>\s*0", sql, flags=re.I))
+    return bool(_RX_BALANCE.search(sql))
 
 
 def add_pending_filter(sql: str) -> str:
@@ -41,7 +53,7 @@ def add_pending_filter(sql: str) -> str:
     sql_clean = sql.rstrip(";").strip()
 
     # Check if WHERE clause exists (case insensitive)
-    match = re.search(r"\bWHERE\b", sql_clean, flags=re.IGNORECASE)
+    match = _RX_WHERE.search(sql_clean)
 
     if match:
         # Insert AND after the WHERE keyword
@@ -62,7 +74,7 @@ def add_pending_filter(sql: str) -> str:
         # We assume standard structure.
 
         # Try to find GROUP BY / ORDER BY / LIMIT to insert before
-        suffix_match = re.search(r"\b(GROUP BY|ORDER BY|LIMIT)\b", sql_clean, flags=re.IGNORECASE)
+        suffix_match = _RX_SUFFIX.search(sql_clean)
         if suffix_match:
             s_start, _ = suffix_match.span()
             return f"{sql_clean[:s_start]} WHERE balance_qty > 0 {sql_clean[s_start:]}"
@@ -70,63 +82,139 @@ def add_pending_filter(sql: str) -> str:
             return f"{sql_clean} WHERE balance_qty > 0"
 
 
-def save_chat_record(db_session, session_id, user_message=None, generated_sql=None, ai_message=None):
+async def save_chat_records(db_session, records):
+    """
+    Saves (session_id, user_message, generated_sql, ai_message) tuples as one multi-row INSERT.
+    Write-only log table: a Core INSERT skips the ORM unit-of-work (identity map, flush, events).
+    """
+    if not records:
+        return
     try:
-        record = ChatHistory(
-            session_id=session_id,
-            user_message=user_message,
-            generated_sql=generated_sql,
-            ai_message=ai_message
-        )
-        db_session.add(record)
-        db_session.commit()
+        await db_session.execute(insert(ChatHistory).values([
+            {"session_id": session_id, "user_message": user_message,
+             "generated_sql": generated_sql, "ai_message": ai_message}
+            for session_id, user_message, generated_sql, ai_message in records
+        ]))
+        await db_session.commit()
     except Exception as e:
-        db_session.rollback()
+        await db_session.rollback()
         print("ORM Chat History Save Error:", e)
 
 
 def remove_bind_params(sql: str) -> str:
-    cleaned = re.sub(r":\w+", "''", sql)  # replace :abc with ''
-    cleaned = re.sub(r"\$\d+", "''", cleaned)  # replace $1 with ''
-    cleaned = re.sub(r"@\w+", "''", cleaned)  # replace @p1 with ''
-    return cleaned
+    # One pass: replace :abc, $1 and @p1 with ''
+    return _RX_BIND.sub("''", sql)
 
 
-def remove_hallucinated_item_filters(sql: str, allowed_items: set | None = None) -> str:
+def _is_hallucinated_item_filter(cond: exp.Expression, allowed_items: set | None, question: str, leading: bool) -> bool:
+    """True for `item_no|description ILIKE '<literal>'` whose literal the user never asked for."""
+    if not isinstance(cond, exp.ILike):
+        return False
+    column, value = cond.this, cond.expression
+    if not (isinstance(column, exp.Column) and column.name.lower() in ITEM_FILTER_COLUMNS):
+        return False
+    if not (isinstance(value, exp.Literal) and value.is_string):
+        return False
+    tok = value.this.strip("%").upper()
+    if tok in question:
+        return False
+    # A leading description filter is usually the subject of the question ("orders for steel pipe")
+    if leading and column.name.lower() == "description":
+        return False
+    if not allowed_items:
+        # Remove all item/desc filters if no context exists
+        return True
+    # Allow partial matches if they are significant
+    return not any(ai in tok or tok in ai for ai in allowed_items)
+
+
+def _is_hallucinated_conjunct(cond: exp.Expression, allowed_items: set | None, question: str, leading: bool) -> bool:
+    """A conjunct goes only if it is one hallucinated filter or a parenthesized OR made up of them."""
+    if isinstance(cond, exp.Paren):
+        cond = cond.unnest()
+    branches = list(cond.flatten()) if isinstance(cond, exp.Or) else [cond]
+    return all(_is_hallucinated_item_filter(b, allowed_items, question, leading) for b in branches)
+
+
+def _remove_hallucinated_item_filters(tree: exp.Expression, allowed_items: set | None, question: str) -> bool:
+    """
+    Drops AND-joined item filters on values the user never mentioned from every WHERE (CTEs and subqueries included).
+    OR branches are never split, so "item A or item B" keeps both items.
+    """
+    changed = False
+    question = question.upper()
+    for where in list(tree.find_all(exp.Where)):
+        conjuncts = list(where.this.flatten()) if isinstance(where.this, exp.And) else [where.this]
+        kept = [c for i, c in enumerate(conjuncts)
+                if not _is_hallucinated_conjunct(c, allowed_items, question, leading=i == 0)]
+        if len(kept) == len(conjuncts):
+            continue
+        if kept:
+            where.set("this", exp.and_(*kept, copy=False))
+        else:
+            where.pop()
+        changed = True
+    return changed
+
+
+def _has_balance_filter(tree: exp.Expression | None) -> bool:
+    return tree is not None and any(
+        isinstance(gt.this, exp.Column) and gt.this.name.lower() == "balance_qty"
+        and isinstance(gt.expression, exp.Literal) and gt.expression.this == "0"
+        for gt in tree.find_all(exp.GT)
+    )
+
+
+def _add_pending_filters(tree: exp.Expression) -> bool:
+    """
+    Adds balance_qty > 0 to every SELECT that reads the open order view directly
+    (CTE bodies, derived tables and UNION branches included), not to SELECTs over their output columns.
+    """
+    changed = False
+    for from_ in list(tree.find_all(exp.From)):
+        select, table = from_.parent, from_.this
+        if not (isinstance(select, exp.Select) and isinstance(table, exp.Table)):
+            continue
+        if table.name.lower() != TABLE_NAME or table.db.lower() not in ("", SCHEMA_NAME):
+            continue
+        if _has_balance_filter(select.args.get("where")):
+            continue
+        # Qualify with the alias so the filter stays unambiguous next to joined tables
+        column = exp.column("balance_qty", table=table.alias or None)
+        # where() ANDs it with (and parenthesizes) any existing filter
+        select.where(exp.GT(this=column, expression=exp.Literal.number(0)), copy=False)
+        changed = True
+    return changed
+
+
+def rewrite_generated_sql(sql: str, allowed_items: set | None, pending: bool, row_limit: int, question: str = "") -> str:
+    """
+    Applies all post-generation fixes with a single parse/serialize:
+    drops item filters the question never asked for, adds balance_qty > 0 for pending questions and enforces a LIMIT.
+    Falls back to the string heuristics when the SQL is not one parseable query.
+    """
     if not sql: return sql
-    s = sql
+    try:
+        tree = sqlglot.parse_one(sql, dialect="postgres")
+    except sqlglot.errors.ParseError:
+        tree = None
 
-    # Find all ILIKE tokens for item_no/description
-    # Expanded regex to capture standard SQL string literals
-    ilike_patterns = re.findall(r"(item_no|description)\s+ILIKE\s+'%?([^'%]+)%?'", s, flags=re.IGNORECASE)
+    if not isinstance(tree, exp.Query):
+        print("SQL rewrite: not a single parseable query, using string heuristics")
+        if pending and not has_balance_filter(sql):
+            sql = add_pending_filter(sql)
+        if "limit" not in sql.lower():
+            sql = sql.strip().rstrip(";") + f" LIMIT {row_limit};"
+        return sql
 
-    if not allowed_items:
-        # Remove all item/desc filters if no context exists
-        s = re.sub(r"\bAND\s*\(\s*item_no\s+ILIKE\s+'[^']+'(?:\s*OR\s*description\s+ILIKE\s+'[^']+')?\s*\)", "", s,
-                   flags=re.IGNORECASE)
-        s = re.sub(r"\bAND\s*item_no\s+ILIKE\s+'[^']+'", "", s, flags=re.IGNORECASE)
-        s = re.sub(r"\bAND\s*description\s+ILIKE\s+'[^']+'", "", s, flags=re.IGNORECASE)
-        # Also handle WHERE clauses if they are the only filter
-        s = re.sub(r"\bWHERE\s*item_no\s+ILIKE\s+'[^']+'", "WHERE 1=1", s, flags=re.IGNORECASE)
-        return s
-
-    def clause_should_stay(token: str) -> bool:
-        tok = token.upper()
-        for ai in allowed_items:
-            # Allow partial matches if they are significant
-            if ai in tok or tok in ai:
-                return True
-        return False
+    changed = _remove_hallucinated_item_filters(tree, allowed_items, question)
+
+    if pending and _add_pending_filters(tree):
+        changed = True
+
+    if tree.args.get("limit") is None:
+        tree.limit(row_limit, copy=False)
+        changed = True
 
-    for field, token in ilike_patterns:
-        if not clause_should_stay(token):
-            token_esc = re.escape(token)
-            # Remove complex OR clause
-            s = re.sub(
-                rf"\bAND\s*\(\s*item_no\s+ILIKE\s+'%?{token_esc}%?'\s*(?:\s*OR\s*description\s+ILIKE\s+'%?{token_esc}%?')?\s*\)",
-                "", s, flags=re.IGNORECASE)
-            # Remove single clauses
-            s = re.sub(rf"\bAND\s*item_no\s+ILIKE\s+'%?{token_esc}%?'", "", s, flags=re.IGNORECASE)
-            s = re.sub(rf"\bAND\s*description\s+ILIKE\s+'%?{token_esc}%?'", "", s, flags=re.IGNORECASE)
-
-    return s
\ No newline at end of file
+    # Untouched queries are returned verbatim rather than re-rendered
+    return tree.sql(dialect="postgres") if changed else sql
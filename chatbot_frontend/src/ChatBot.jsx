@@ -46,8 +46,30 @@ export default function ChatBot() {
         headers: { "Content-Type": "application/json" },
         body: JSON.stringify({ message: userMsg.text, session_id: sessionId }),
       });
-      const data = await res.json();
-      setMessages(prev => [...prev, { sender: "bot", text: data.reply }]);
+      if (!res.ok || !res.body) throw new Error(`HTTP ${res.status}`);
+
+      // The reply arrives as Server-Sent Events: append each token to one bot bubble.
+      setMessages(prev => [...prev, { sender: "bot", text: "" }]);
+      const appendToken = (token) => setMessages(prev => {
+        const last = prev[prev.length - 1];
+        return [...prev.slice(0, -1), { ...last, text: last.text + token }];
+      });
+
+      const reader = res.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = "";
+      while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        const frames = buffer.split("\n\n");
+        buffer = frames.pop();
+        for (const frame of frames) {
+          if (frame.startsWith("event:")) continue; // meta / done frames carry no text
+          const data = frame.split("\n").find(line => line.startsWith("data: "));
+          if (data) appendToken(JSON.parse(data.slice(6)).token || "");
+        }
+      }
     } catch (err) {
       setMessages(prev => [...prev, { sender: "bot", text: "⚠️ I couldn't connect to the server." }]);
     }